@@ -0,0 +1,239 @@
+# benchmark.py
+#
+# Measures how update throughput scales with the number of worker processes in
+# multi-process mode (WORKERS > 1). Simulated users place an order through the real
+# conversation: the dispatcher routes each Telegram update payload to a worker by user
+# ID, and the worker feeds it to the bot's own handlers through PTB, ending with the
+# balance charge and order log going through the single DB writer process. Only the
+# network is replaced: Bot API calls and the SMM panel are answered locally, with the
+# panel returning a large `services` response that the handlers parse as usual.
+#
+# Usage: python benchmark.py [--users 300] [--workers 1,2,4] [--services 2000]
+
+import os
+import json
+import time
+import random
+import sqlite3
+import argparse
+import asyncio
+import logging
+import warnings
+import itertools
+import tempfile
+import multiprocessing
+from types import SimpleNamespace
+
+# Measure throughput, not load shedding: every update must reach its handler
+os.environ["SCHED_SHED_THRESHOLD"] = str(10 ** 9)
+
+from telegram.request import BaseRequest
+from telegram.warnings import PTBUserWarning
+
+import bot
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+MESSAGE_METHODS = ("sendMessage", "editMessageText", "editMessageCaption", "sendPhoto", "sendDocument")
+QUANTITY = 1000
+STEPS_PER_ORDER = 6
+
+
+class OfflineBotRequest(BaseRequest):
+    """Answers Bot API calls locally, so handlers run unchanged without network access."""
+
+    def __init__(self):
+        self.message_ids = itertools.count(1000)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint in MESSAGE_METHODS:
+            parameters = request_data.parameters if request_data else {}
+            result = {"message_id": next(self.message_ids), "date": int(time.time()), "text": "",
+                      "chat": {"id": parameters.get("chat_id") or 1, "type": "private"}}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def make_services_payload(count):
+    categories = [f"Category {i}" for i in range(40)]
+    services = [
+        {
+            "service": i,
+            "name": f"Service {i} - High Quality Followers [Refill {i % 30} Days]",
+            "category": random.choice(categories),
+            "rate": f"{random.uniform(0.1, 50):.4f}",
+            "min": "10",
+            "max": "100000",
+        }
+        for i in range(count)
+    ]
+    return json.dumps(services)
+
+
+def offline_smm_api(services_payload):
+    def smm_api_call(action, params=None):
+        if action == "services":
+            return json.loads(services_payload)
+        if action == "add":
+            # The link carries the user ID, which doubles as a unique order ID
+            return {"order": int(params["link"].rsplit("u", 1)[1])}
+        return {}
+    return smm_api_call
+
+
+def order_updates(user_id, services, update_ids):
+    """Returns the Telegram update payloads of one user placing one order, in order."""
+    user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+    chat = {"id": user_id, "type": "private"}
+    service = services[user_id % len(services)]
+
+    def callback(data):
+        message = {"message_id": 1, "date": int(time.time()), "chat": chat, "from": BOT_USER, "text": "menu"}
+        return {"update_id": next(update_ids), "callback_query": {
+            "id": str(next(update_ids)), "from": user, "chat_instance": str(user_id), "message": message, "data": data}}
+
+    def text(value):
+        return {"update_id": next(update_ids), "message": {
+            "message_id": 2, "date": int(time.time()), "chat": chat, "from": user, "text": value}}
+
+    return [
+        callback("new_order_category"),
+        callback(f"cat_{service['category']}"),
+        callback(f"svc_{service['service']}"),
+        text(f"https://t.me/u{user_id}"),
+        text(str(QUANTITY)),
+        callback("confirm_order_final"),
+    ]
+
+
+def bench_worker(worker_index, update_queue, request_queue, response_queue, services_payload):
+    """Same as bot.run_worker, with the network replaced and no background jobs."""
+    # Keep the output readable: conversation timeout jobs log every add/remove
+    logging.getLogger("apscheduler").setLevel(logging.WARNING)
+    logging.getLogger("telegram.ext").setLevel(logging.WARNING)
+    warnings.filterwarnings("ignore", category=PTBUserWarning)
+    bot.BOT_TOKEN = "123456:offline-benchmark"
+    bot.smm_api_call = offline_smm_api(services_payload)
+    bot.db_writer = bot.DatabaseWriterClient(worker_index, request_queue, response_queue)
+    bot.referral_graph.load()
+    application = bot.build_application(updater=False, request=OfflineBotRequest())
+    asyncio.run(bot.feed_worker(application, update_queue))
+
+
+async def dispatch(payloads, worker_queues):
+    """Routes payloads the way the dispatcher does: parse, pick the worker, re-serialize."""
+    context = SimpleNamespace(bot_data={"worker_queues": worker_queues})
+    for data in payloads:
+        await bot.route_update(bot.Update.de_json(data, None), context)
+
+
+def count_orders():
+    conn = sqlite3.connect(bot.DB_FILE)
+    count = conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+    conn.close()
+    return count
+
+
+def wait_for_orders(expected, timeout):
+    deadline = time.monotonic() + timeout
+    while count_orders() < expected:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Only {count_orders()} of {expected} orders were placed within {timeout}s")
+        time.sleep(0.02)
+
+
+def run(workers, users, services_payload):
+    services = json.loads(services_payload)
+    update_ids = itertools.count(1)
+    # One warm-up user per worker, so process startup and PTB initialization are not timed
+    warmup_ids = list(range(1, workers + 1))
+    user_ids = list(range(workers + 1, workers + 1 + users))
+
+    conn = sqlite3.connect(bot.DB_FILE)
+    conn.executemany("INSERT INTO users (user_id, username, balance) VALUES (?, ?, ?)",
+                     [(user_id, f"user{user_id}", 10 ** 9) for user_id in warmup_ids + user_ids])
+    conn.commit()
+    conn.close()
+
+    mp_context = multiprocessing.get_context("spawn")
+    request_queue = mp_context.Queue()
+    response_queues = [mp_context.Queue() for _ in range(workers)]
+    update_queues = [mp_context.Queue() for _ in range(workers)]
+
+    writer = mp_context.Process(target=bot.run_db_writer, args=(request_queue, response_queues, None))
+    processes = [
+        mp_context.Process(target=bench_worker, args=(i, update_queues[i], request_queue, response_queues[i],
+                                                      services_payload))
+        for i in range(workers)
+    ]
+    writer.start()
+    for process in processes:
+        process.start()
+    try:
+        warmup = [order_updates(user_id, services, update_ids) for user_id in warmup_ids]
+        asyncio.run(dispatch([u for flow in warmup for u in flow], update_queues))
+        wait_for_orders(len(warmup_ids), timeout=120)
+
+        # Interleave users step by step, keeping each user's own updates in order
+        flows = [order_updates(user_id, services, update_ids) for user_id in user_ids]
+        payloads = [flow[step] for step in range(STEPS_PER_ORDER) for flow in flows]
+        started = time.perf_counter()
+        asyncio.run(dispatch(payloads, update_queues))
+        wait_for_orders(len(warmup_ids) + len(user_ids), timeout=600)
+        elapsed = time.perf_counter() - started
+    finally:
+        for update_queue in update_queues:
+            update_queue.put(None)
+        for process in processes:
+            process.join(timeout=30)
+        request_queue.put(None)
+        writer.join(timeout=30)
+        for process in processes + [writer]:
+            if process.is_alive():
+                process.terminate()
+    return len(payloads), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-process throughput benchmark")
+    parser.add_argument("--users", type=int, default=300, help="users placing one order each")
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--services", type=int, default=2000)
+    args = parser.parse_args()
+
+    services_payload = make_services_payload(args.services)
+    print(f"CPUs: {os.cpu_count()}, users: {args.users} ({args.users * STEPS_PER_ORDER} updates), "
+          f"services per response: {args.services}")
+    print(f"{'workers':>8} {'updates/s':>10} {'speedup':>8}")
+    baseline = None
+    original_cwd = os.getcwd()
+    for workers in [int(w) for w in args.workers.split(",")]:
+        with tempfile.TemporaryDirectory() as workdir:
+            os.chdir(workdir) # Children inherit the cwd, so they all use this fresh smm_bot.db
+            try:
+                bot.setup_database()
+                bot.setup_archive_database()
+                handled, elapsed = run(workers, args.users, services_payload)
+            finally:
+                os.chdir(original_cwd)
+        throughput = handled / elapsed
+        baseline = baseline or throughput
+        print(f"{workers:>8} {throughput:>10.1f} {throughput / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
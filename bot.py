@@ -1,8 +1,25 @@
 # bot.py
 
 import os
+import io
+import sys
+import csv
+import gzip
+import queue
+import pickle
+import signal
+import itertools
+import multiprocessing
+import asyncio
 import logging
+import collections
+import shutil
+import bisect
 import sqlite3
+import tempfile
+import time
+import threading
+import traceback
 import requests
 from datetime import datetime, timedelta
 
@@ -13,14 +30,17 @@ from telegram import (
     ForceReply,
     constants
 )
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     filters,
     ContextTypes,
     ConversationHandler,
+    TypeHandler,
 )
 
 # --- Configuration ---
@@ -35,9 +55,41 @@ PAYMENT_CHANNEL = os.getenv("PAYMENT_CHANNEL")
 UPI_ID = os.getenv("UPI_ID")
 MARKUP_PERCENT = int(os.getenv("MARKUP_PERCENT", "20"))
 REFERRAL_PERCENT = int(os.getenv("REFERRAL_PERCENT", "10"))
+# Commission percent per referral level, e.g. "10,3,1" pays three levels up the chain
+REFERRAL_TIERS = [float(p) for p in os.getenv("REFERRAL_TIERS", str(REFERRAL_PERCENT)).split(",")]
 BONUS_ENABLED = os.getenv("BONUS_ENABLED", "True").lower() == "true"
 REDEEM_ENABLED = os.getenv("REDEEM_ENABLED", "True").lower() == "true"
 DAILY_BONUS_AMOUNT = 10 # Example bonus amount
+BONUS_COOLDOWN_SECONDS = 24 * 3600
+BONUS_REMINDER_ENABLED = os.getenv("BONUS_REMINDER_ENABLED", "False").lower() == "true"
+SCHED_MAX_CONCURRENT = int(os.getenv("SCHED_MAX_CONCURRENT", "8"))
+SCHED_SHED_THRESHOLD = int(os.getenv("SCHED_SHED_THRESHOLD", "100"))
+SCHED_MAX_PENDING = 1000 # Updates admitted to the scheduler before further ones wait unclassified
+PROFILE_INTERVAL = 0.01 # Seconds between stack samples
+PROFILE_MAX_SECONDS = 300
+PROFILE_SLOW_CALLBACK_MS = int(os.getenv("PROFILE_SLOW_CALLBACK_MS", "100"))
+WORKERS = int(os.getenv("WORKERS", "1"))
+WRITER_BATCH_SIZE = 200 # Max write requests group-committed in one transaction
+WRITER_TIMEOUT = 30 # Seconds a worker waits for the DB writer to answer a write
+WRITER_CALL_TIMEOUT = 1800 # Whole-database tasks (archival, restore) can run for minutes
+PROCESS_CHECK_SECONDS = 5 # How often the dispatcher checks that the writer and workers are alive
+REFERRAL_GRAPH_REFRESH_SECONDS = 60 # Workers pull other workers' new referrals and earnings this often
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
+EXPORT_SPOOL_MAX_BYTES = 8 * 1024 * 1024 # Spill exports to disk above this size
+EXPORT_PART_MAX_BYTES = 45 * 1024 * 1024 # Start a new file below Telegram's 50 MB bot upload limit
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_INTERVAL_HOURS = float(os.getenv("ARCHIVE_INTERVAL_HOURS", "24"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_BATCH_PAUSE = 0.05 # Seconds between batches so writers can grab the lock
+ORDER_STATUS_INTERVAL_MINUTES = float(os.getenv("ORDER_STATUS_INTERVAL_MINUTES", "30"))
+ORDER_STATUS_BATCH_SIZE = 100 # Order IDs per multi-order SMM `status` request
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "6"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "14"))
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "64"))
+BACKUP_STEP_PAUSE = 0.02 # Seconds between backup steps so writers can run
+BACKUP_MAX_RESTARTS = 5 # Finish in a single step once writes have restarted the copy this often
+BACKUP_PROBE_INTERVAL = 0.005 # Seconds between write-lock probes that measure writer stalls during a backup
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -48,10 +100,13 @@ logger = logging.getLogger(__name__)
 
 # --- Database Setup ---
 DB_FILE = "smm_bot.db"
+ARCHIVE_DB_FILE = "smm_bot_archive.db"
 
 def setup_database():
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
+    # WAL lets readers, backups and the writer run side by side without blocking each other
+    cursor.execute("PRAGMA journal_mode=WAL")
     # Users table
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS users (
@@ -60,7 +115,8 @@ def setup_database():
         balance REAL DEFAULT 0.0,
         referred_by INTEGER,
         join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        last_bonus_claim TIMESTAMP
+        last_bonus_claim TIMESTAMP,
+        last_bonus_epoch INTEGER
     )
     """)
     # Orders table
@@ -89,6 +145,84 @@ def setup_database():
         chat_id INTEGER
     )
     """)
+    # Daily bonus claim time as a unix epoch; backfilled from the old ISO column
+    cursor.execute("PRAGMA table_info(users)")
+    user_columns = [row[1] for row in cursor.fetchall()]
+    if "last_bonus_epoch" not in user_columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN last_bonus_epoch INTEGER")
+        cursor.execute(
+            "UPDATE users SET last_bonus_epoch = CAST(strftime('%s', last_bonus_claim, 'utc') AS INTEGER) "
+            "WHERE last_bonus_claim IS NOT NULL"
+        )
+    # First approved deposit, so the referral check needs no scan of deposits
+    if "first_deposit_at" not in user_columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN first_deposit_at TIMESTAMP")
+        cursor.execute(
+            "UPDATE users SET first_deposit_at = (SELECT MIN(timestamp) FROM deposits d "
+            "WHERE d.user_id = users.user_id AND d.status = 'approved')"
+        )
+        if os.path.exists(ARCHIVE_DB_FILE):
+            conn.commit()
+            cursor.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_FILE,))
+            cursor.execute(
+                "UPDATE users SET first_deposit_at = (SELECT MIN(timestamp) FROM archive.deposits d "
+                "WHERE d.user_id = users.user_id AND d.status = 'approved') "
+                "WHERE first_deposit_at IS NULL"
+            )
+            conn.commit()
+            cursor.execute("DETACH DATABASE archive")
+    # Referral commissions paid, one row per referrer per level
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS referral_earnings (
+        earning_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        referrer_id INTEGER,
+        referee_id INTEGER,
+        deposit_id INTEGER,
+        level INTEGER,
+        amount REAL,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    # Indexes for per-user lookups and archival scans
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users (referred_by)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_join_date ON users (join_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_referral_earnings_referrer ON referral_earnings (referrer_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_time ON orders (user_id, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_time ON orders (status, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_deposits_status_time ON deposits (status, timestamp)")
+    conn.commit()
+    conn.close()
+
+def setup_archive_database():
+    conn = sqlite3.connect(ARCHIVE_DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # Same columns as the hot tables so rows can be moved with INSERT ... SELECT *
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS orders (
+        order_id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        service_id INTEGER,
+        link TEXT,
+        quantity INTEGER,
+        charge REAL,
+        status TEXT,
+        timestamp TIMESTAMP
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS deposits (
+        deposit_id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        amount REAL,
+        status TEXT,
+        timestamp TIMESTAMP,
+        message_id INTEGER,
+        chat_id INTEGER
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_time ON orders (user_id, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_deposits_user_status ON deposits (user_id, status)")
     conn.commit()
     conn.close()
 
@@ -110,6 +244,28 @@ def smm_api_call(action, params=None):
         return None
 
 # --- Database Helper Functions ---
+# Set in worker processes, where all writes go through the single DB writer process
+db_writer = None
+
+def execute_statements(cursor, statements):
+    results = []
+    for sql, params in statements:
+        cursor.execute(sql, params)
+        results.append((cursor.rowcount, cursor.lastrowid))
+    return results
+
+def db_write(*statements):
+    """Runs (sql, params) statements in one transaction. Returns a (rowcount, lastrowid) pair per statement."""
+    if db_writer is not None:
+        return db_writer.execute(statements)
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        results = execute_statements(conn.cursor(), statements)
+        conn.commit()
+    finally:
+        conn.close()
+    return results
+
 def get_user(user_id):
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
@@ -126,62 +282,287 @@ def get_user(user_id):
 def add_user(user_id, username, referred_by=None):
     if get_user(user_id):
         return
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO users (user_id, username, referred_by) VALUES (?, ?, ?)",
-        (user_id, username, referred_by)
-    )
-    conn.commit()
-    conn.close()
+    if referred_by and not get_user(referred_by):
+        referred_by = None # Only record referrals from users who actually exist
+    db_write(("INSERT INTO users (user_id, username, referred_by) VALUES (?, ?, ?)", (user_id, username, referred_by)))
+    if referred_by:
+        referral_graph.add_referral(user_id, referred_by)
 
 def update_balance(user_id, amount):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
-    conn.commit()
-    conn.close()
+    db_write(("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id)))
 
 def log_order(api_order_id, user_id, service_id, link, quantity, charge, status):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
+    """Logs a placed order and deducts its charge from the user's balance in one transaction."""
+    db_write(
+        ("UPDATE users SET balance = balance - ? WHERE user_id = ?", (charge, user_id)),
+        ("""
     INSERT INTO orders (order_id, user_id, service_id, link, quantity, charge, status)
     VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (api_order_id, user_id, service_id, link, quantity, charge, status))
-    conn.commit()
-    conn.close()
+    """, (api_order_id, user_id, service_id, link, quantity, charge, status)),
+    )
 
-def get_user_orders(user_id):
-    conn = sqlite3.connect(DB_FILE)
+def get_user_orders(user_id, archived=False):
+    conn = sqlite3.connect(ARCHIVE_DB_FILE if archived else DB_FILE)
     cursor = conn.cursor()
     cursor.execute("SELECT service_id, quantity, status, order_id FROM orders WHERE user_id = ? ORDER BY timestamp DESC LIMIT 10", (user_id,))
     orders = cursor.fetchall()
     conn.close()
     return orders
 
+def count_orders(user_id=None):
+    """Counts orders across the live and archive databases, optionally for one user."""
+    total = 0
+    for db_file in (DB_FILE, ARCHIVE_DB_FILE):
+        conn = sqlite3.connect(db_file)
+        cursor = conn.cursor()
+        if user_id is None:
+            cursor.execute("SELECT COUNT(*) FROM orders")
+        else:
+            cursor.execute("SELECT COUNT(*) FROM orders WHERE user_id = ?", (user_id,))
+        total += cursor.fetchone()[0]
+        conn.close()
+    return total
+
+def update_order_status(order_id, status):
+    db_write(("UPDATE orders SET status = ? WHERE order_id = ?", (status, order_id)))
+
+def approve_deposit_payment(deposit_id, user_id, amount):
+    """Approves a pending deposit and credits it in one transaction. Returns (approved, first_deposit)."""
+    # changes() is the previous statement's row count, so nothing is credited unless the deposit was still pending
+    [(approved, _), _, (first_deposit, _)] = db_write(
+        ("UPDATE deposits SET status = 'approved' WHERE deposit_id = ? AND status = 'pending'", (deposit_id,)),
+        ("UPDATE users SET balance = balance + ? WHERE user_id = ? AND changes() = 1", (amount, user_id)),
+        ("UPDATE users SET first_deposit_at = CURRENT_TIMESTAMP "
+         "WHERE user_id = ? AND first_deposit_at IS NULL AND changes() = 1", (user_id,)),
+    )
+    return approved == 1, first_deposit == 1
+
+def pay_referral_commission(referrer_id, referee_id, deposit_id, level, amount):
+    [_, (_, earning_id)] = db_write(
+        ("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, referrer_id)),
+        ("INSERT INTO referral_earnings (referrer_id, referee_id, deposit_id, level, amount) VALUES (?, ?, ?, ?, ?)",
+         (referrer_id, referee_id, deposit_id, level, amount)),
+    )
+    referral_graph.add_earnings(referrer_id, amount, earning_id)
+
+# user_id -> epoch at which the next daily bonus can be claimed (0 = ready)
+bonus_next_claim = {}
+
+def get_bonus_next_claim(user_id):
+    next_claim = bonus_next_claim.get(user_id)
+    if next_claim is None:
+        conn = sqlite3.connect(DB_FILE)
+        cursor = conn.cursor()
+        cursor.execute("SELECT last_bonus_epoch FROM users WHERE user_id = ?", (user_id,))
+        row = cursor.fetchone()
+        conn.close()
+        next_claim = row[0] + BONUS_COOLDOWN_SECONDS if row and row[0] else 0
+        bonus_next_claim[user_id] = next_claim
+    return next_claim
+
 def can_claim_bonus(user_id):
-    user = get_user(user_id)
-    if not user or not user.get("last_bonus_claim"):
-        return True, "Ready to claim!"
-    
-    last_claim_time = datetime.fromisoformat(user["last_bonus_claim"])
-    cooldown = timedelta(hours=24)
-    if datetime.now() > last_claim_time + cooldown:
+    remaining = get_bonus_next_claim(user_id) - time.time()
+    if remaining <= 0:
         return True, "Ready to claim!"
+    hours, remainder = divmod(int(remaining), 3600)
+    minutes, _ = divmod(remainder, 60)
+    return False, f"{hours}h {minutes}m remaining"
+
+def claim_daily_bonus(user_id):
+    """Pays the bonus in one conditional UPDATE, so repeated clicks can never pay twice. Returns True if paid."""
+    now = int(time.time())
+    [(rowcount, _)] = db_write((
+        "UPDATE users SET balance = balance + ?, last_bonus_epoch = ? "
+        "WHERE user_id = ? AND (last_bonus_epoch IS NULL OR last_bonus_epoch <= ?)",
+        (DAILY_BONUS_AMOUNT, now, user_id, now - BONUS_COOLDOWN_SECONDS)
+    ))
+    claimed = rowcount == 1
+    if claimed:
+        bonus_next_claim[user_id] = now + BONUS_COOLDOWN_SECONDS
     else:
-        next_claim_time = last_claim_time + cooldown
-        remaining = next_claim_time - datetime.now()
-        hours, remainder = divmod(remaining.seconds, 3600)
-        minutes, _ = divmod(remainder, 60)
-        return False, f"{hours}h {minutes}m remaining"
+        # Reload from the DB next time in case the cached value was stale
+        bonus_next_claim.pop(user_id, None)
+    return claimed
+
+# --- Referral Graph ---
+class ReferralGraph:
+    """In-memory referral tree with per-level downline counts and sorted leaderboards, updated incrementally."""
+
+    def __init__(self):
+        # Writes run in worker threads, so updates to the shared structures are serialized
+        self.lock = threading.Lock()
+        self.parent = {}
+        self.direct_counts = collections.Counter()
+        self.earnings = collections.defaultdict(float)
+        self.level_counts = {}
+        # Users known to have joined without a referrer; referred_by never changes later
+        self.no_referrer = set()
+        # Sorted (-value, user_id) pairs
+        self.referrals_board = []
+        self.earnings_board = []
+        # Refresh watermarks: newest join_date and earning_id already loaded
+        self.join_watermark = None
+        self.earning_watermark = 0
+        self.applied_earnings = set() # Earning ids above the watermark already counted
+
+    def load(self):
+        conn = sqlite3.connect(DB_FILE)
+        cursor = conn.cursor()
+        cursor.execute("SELECT MAX(join_date) FROM users")
+        join_watermark = cursor.fetchone()[0]
+        cursor.execute("SELECT user_id, referred_by FROM users WHERE referred_by IS NOT NULL")
+        parent = dict(cursor.fetchall())
+        cursor.execute("SELECT COALESCE(MAX(earning_id), 0) FROM referral_earnings")
+        earning_watermark = cursor.fetchone()[0]
+        cursor.execute("SELECT referrer_id, SUM(amount) FROM referral_earnings WHERE earning_id <= ? GROUP BY referrer_id",
+                       (earning_watermark,))
+        earnings = collections.defaultdict(float, cursor.fetchall())
+        conn.close()
+
+        direct_counts = collections.Counter(parent.values())
+        with self.lock:
+            self.parent = parent
+            self.earnings = earnings
+            self.direct_counts = direct_counts
+            self.level_counts = {}
+            self.no_referrer = set()
+            self.referrals_board = sorted((-count, user_id) for user_id, count in direct_counts.items())
+            self.earnings_board = sorted((-amount, user_id) for user_id, amount in earnings.items())
+            self.join_watermark = join_watermark
+            self.earning_watermark = earning_watermark
+            self.applied_earnings = set()
+
+    def refresh(self):
+        """Applies referrals and earnings recorded by other processes since the last load or refresh."""
+        conn = sqlite3.connect(DB_FILE)
+        cursor = conn.cursor()
+        cursor.execute("SELECT MAX(join_date) FROM users")
+        join_watermark = cursor.fetchone()[0]
+        # Re-read the last minute too: join_date has one-second resolution and commits can land out of order
+        cursor.execute("SELECT user_id, referred_by FROM users "
+                       "WHERE join_date >= COALESCE(datetime(?, '-1 minute'), '') AND referred_by IS NOT NULL ORDER BY join_date",
+                       (self.join_watermark,))
+        referrals = cursor.fetchall()
+        cursor.execute("SELECT earning_id, referrer_id, amount FROM referral_earnings WHERE earning_id > ? ORDER BY earning_id",
+                       (self.earning_watermark,))
+        earnings = cursor.fetchall()
+        conn.close()
+
+        for user_id, referrer_id in referrals:
+            self.add_referral(user_id, referrer_id)
+        for earning_id, referrer_id, amount in earnings:
+            self.add_earnings(referrer_id, amount, earning_id)
+        with self.lock:
+            self.join_watermark = join_watermark or self.join_watermark
+            if earnings:
+                self.earning_watermark = max(self.earning_watermark, earnings[-1][0])
+                self.applied_earnings = {i for i in self.applied_earnings if i > self.earning_watermark}
+
+    @staticmethod
+    def move_on_board(board, user_id, old_value, new_value):
+        if old_value:
+            index = bisect.bisect_left(board, (-old_value, user_id))
+            if index < len(board) and board[index] == (-old_value, user_id):
+                board.pop(index)
+        bisect.insort(board, (-new_value, user_id))
+
+    def add_referral(self, user_id, referrer_id):
+        with self.lock:
+            if user_id in self.parent: # Already seen, e.g. picked up again by refresh()
+                return
+            self.parent[user_id] = referrer_id
+            old_count = self.direct_counts[referrer_id]
+            self.direct_counts[referrer_id] = old_count + 1
+            self.move_on_board(self.referrals_board, referrer_id, old_count, old_count + 1)
+            # Bump cached downline sizes of every ancestor at the matching level
+            for level, ancestor_id in enumerate(self.ancestors(user_id, len(REFERRAL_TIERS)), 1):
+                counts = self.level_counts.get(ancestor_id)
+                if counts is not None:
+                    counts[level - 1] += 1
+
+    def add_earnings(self, referrer_id, amount, earning_id):
+        with self.lock:
+            # Both the paying handler and refresh() may report the same earning
+            if earning_id <= self.earning_watermark or earning_id in self.applied_earnings:
+                return
+            self.applied_earnings.add(earning_id)
+            old_amount = self.earnings[referrer_id]
+            self.earnings[referrer_id] = old_amount + amount
+            self.move_on_board(self.earnings_board, referrer_id, old_amount, old_amount + amount)
+
+    def referrer_of(self, user_id):
+        if user_id in self.parent:
+            return self.parent[user_id]
+        # In a single process every referral goes through add_referral, so a miss is final
+        if db_writer is None or user_id in self.no_referrer:
+            return None
+        # With several worker processes the user may have joined through another worker
+        # since the last refresh, so confirm against the DB rather than trust the miss
+        conn = sqlite3.connect(DB_FILE)
+        cursor = conn.cursor()
+        cursor.execute("SELECT referred_by FROM users WHERE user_id = ?", (user_id,))
+        row = cursor.fetchone()
+        conn.close()
+        if row is None:
+            return None
+        if row[0] is None:
+            self.no_referrer.add(user_id)
+        return row[0]
+
+    def ancestors(self, user_id, depth):
+        """Returns up to `depth` referrers above a user, closest first."""
+        chain = []
+        current = self.referrer_of(user_id)
+        while current is not None and len(chain) < depth and current != user_id:
+            chain.append(current)
+            current = self.referrer_of(current) if len(chain) < depth else None
+        return chain
+
+    def downline_counts(self, user_id):
+        """Returns the number of referred users at each tier level below a user."""
+        counts = self.level_counts.get(user_id)
+        if counts is None:
+            conn = sqlite3.connect(DB_FILE)
+            cursor = conn.cursor()
+            cursor.execute("""
+            WITH RECURSIVE downline(user_id, depth) AS (
+                SELECT user_id, 1 FROM users WHERE referred_by = ?
+                UNION ALL
+                SELECT u.user_id, d.depth + 1 FROM users u JOIN downline d ON u.referred_by = d.user_id
+                WHERE d.depth < ?
+            )
+            SELECT depth, COUNT(*) FROM downline GROUP BY depth
+            """, (user_id, len(REFERRAL_TIERS)))
+            counts = [0] * len(REFERRAL_TIERS)
+            for depth, count in cursor.fetchall():
+                counts[depth - 1] = count
+            conn.close()
+            self.level_counts[user_id] = counts
+        return counts
 
-def update_bonus_claim_time(user_id):
+    def direct_count(self, user_id):
+        return self.direct_counts.get(user_id, 0)
+
+    def lifetime_earnings(self, user_id):
+        return self.earnings.get(user_id, 0.0)
+
+    def top_referrers(self, k):
+        return [(user_id, -count) for count, user_id in self.referrals_board[:k]]
+
+    def top_earners(self, k):
+        return [(user_id, -amount) for amount, user_id in self.earnings_board[:k]]
+
+referral_graph = ReferralGraph()
+
+def get_usernames(user_ids):
+    if not user_ids:
+        return {}
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
-    cursor.execute("UPDATE users SET last_bonus_claim = ? WHERE user_id = ?", (datetime.now().isoformat(), user_id))
-    conn.commit()
+    cursor.execute(f"SELECT user_id, username FROM users WHERE user_id IN ({', '.join('?' * len(user_ids))})", list(user_ids))
+    names = dict(cursor.fetchall())
     conn.close()
+    return names
 
 # --- Message Deletion Helper ---
 async def delete_previous_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
@@ -219,7 +600,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             if potential_referrer_id != user.id:
                 referrer_id = potential_referrer_id
         
-        add_user(user.id, user.username or user.first_name, referrer_id)
+        await asyncio.to_thread(add_user, user.id, user.username or user.first_name, referrer_id)
         await update.message.reply_text(f"🎉 Welcome, {user.first_name}! You've successfully joined.")
 
     await main_menu(update, context)
@@ -289,14 +670,8 @@ async def account_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     user_id = query.from_user.id
     user = get_user(user_id)
-    
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM orders WHERE user_id = ?", (user_id,))
-    total_orders = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM users WHERE referred_by = ?", (user_id,))
-    total_referrals = cursor.fetchone()[0]
-    conn.close()
+    total_orders = count_orders(user_id)
+    total_referrals = referral_graph.direct_count(user_id)
 
     text = (f"👤 **Account Information**\n\n"
             f"**User ID:** `{user['user_id']}`\n"
@@ -346,12 +721,9 @@ async def add_funds_screenshot(update: Update, context: ContextTypes.DEFAULT_TYP
     photo_file = await update.message.photo[-1].get_file()
 
     # Log deposit to DB
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO deposits (user_id, amount, status) VALUES (?, ?, ?)", (user.id, amount, 'pending'))
-    deposit_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    [(_, deposit_id)] = await asyncio.to_thread(
+        db_write, ("INSERT INTO deposits (user_id, amount, status) VALUES (?, ?, ?)", (user.id, amount, 'pending'))
+    )
 
     # Notify admin
     caption = (f"**New Deposit Request**\n\n"
@@ -384,40 +756,34 @@ async def approve_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cursor = conn.cursor()
     cursor.execute("SELECT user_id, amount, status FROM deposits WHERE deposit_id = ?", (deposit_id,))
     deposit_info = cursor.fetchone()
+    conn.close()
     
     if not deposit_info or deposit_info[2] != 'pending':
         await query.edit_message_caption(caption=query.message.caption + "\n\n**Status: Already processed.**", parse_mode=constants.ParseMode.MARKDOWN)
-        conn.close()
         return
 
     user_id, amount, _ = deposit_info
     
-    # Update balance and handle referral
-    update_balance(user_id, amount)
-    
-    user_data = get_user(user_id)
-    if user_data and user_data['referred_by']:
-        referrer_id = user_data['referred_by']
-        # Check if this is the first deposit
-        cursor.execute("SELECT COUNT(*) FROM deposits WHERE user_id = ? AND status = 'approved'", (user_id,))
-        approved_deposits_count = cursor.fetchone()[0]
-        
-        if approved_deposits_count == 0: # This is the first approved deposit
-            referral_bonus = amount * (REFERRAL_PERCENT / 100)
-            update_balance(referrer_id, referral_bonus)
+    # Approve, credit the balance and handle referral
+    approved, first_deposit = await asyncio.to_thread(approve_deposit_payment, deposit_id, user_id, amount)
+    if not approved: # Another click approved or rejected it meanwhile
+        await query.edit_message_caption(caption=query.message.caption + "\n\n**Status: Already processed.**", parse_mode=constants.ParseMode.MARKDOWN)
+        return
+
+    if first_deposit:
+        referrers = await asyncio.to_thread(referral_graph.ancestors, user_id, len(REFERRAL_TIERS))
+        for level, (referrer_id, percent) in enumerate(zip(referrers, REFERRAL_TIERS), 1):
+            referral_bonus = amount * (percent / 100)
+            await asyncio.to_thread(pay_referral_commission, referrer_id, user_id, deposit_id, level, referral_bonus)
+            level_text = "your referral's" if level == 1 else f"a level {level} referral's"
             try:
                 await context.bot.send_message(
                     chat_id=referrer_id,
-                    text=f"🎉 **Referral Bonus!** You've received a bonus of `{referral_bonus:.2f}` coins from your referral's first deposit."
+                    text=f"🎉 **Referral Bonus!** You've received a bonus of `{referral_bonus:.2f}` coins from {level_text} first deposit."
                 )
             except Exception as e:
                 logger.error(f"Failed to send referral bonus notification to {referrer_id}: {e}")
 
-    # Update deposit status
-    cursor.execute("UPDATE deposits SET status = 'approved' WHERE deposit_id = ?", (deposit_id,))
-    conn.commit()
-    conn.close()
-
     # Notify user
     try:
         await context.bot.send_message(chat_id=user_id, text=f"✅ Your deposit of `{amount}` has been approved and added to your balance.")
@@ -446,11 +812,15 @@ async def reject_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     deposit_id = int(query.data.split('_')[2])
     
+    [(rejected, _)] = await asyncio.to_thread(
+        db_write, ("UPDATE deposits SET status = 'rejected' WHERE deposit_id = ? AND status = 'pending'", (deposit_id,))
+    )
+    if not rejected:
+        await query.edit_message_caption(caption=query.message.caption + "\n\n**Status: Already processed.**", parse_mode=constants.ParseMode.MARKDOWN)
+        return
+    
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
-    cursor.execute("UPDATE deposits SET status = 'rejected' WHERE deposit_id = ?", (deposit_id,))
-    conn.commit()
-    
     cursor.execute("SELECT user_id, amount FROM deposits WHERE deposit_id = ?", (deposit_id,))
     user_id, amount = cursor.fetchone()
     conn.close()
@@ -473,7 +843,7 @@ async def new_order_category(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
 
-    services = smm_api_call('services')
+    services = await asyncio.to_thread(smm_api_call, 'services')
     if not services:
         await query.edit_message_text("❌ Could not fetch services from the provider. Please try again later.",
                                       reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back", callback_data="main_menu")]]))
@@ -594,12 +964,11 @@ async def new_order_final(update: Update, context: ContextTypes.DEFAULT_TYPE):
         'link': link,
         'quantity': quantity
     }
-    api_response = smm_api_call('add', order_params)
+    api_response = await asyncio.to_thread(smm_api_call, 'add', order_params)
 
     if api_response and 'order' in api_response:
         api_order_id = api_response['order']
-        update_balance(user_id, -charge)
-        log_order(api_order_id, user_id, service['service'], link, quantity, charge, 'Pending')
+        await asyncio.to_thread(log_order, api_order_id, user_id, service['service'], link, quantity, charge, 'Pending')
         
         text = (f"✅ **Order Placed Successfully!**\n\n"
                 f"**Order ID:** `{api_order_id}`\n"
@@ -647,12 +1016,13 @@ async def track_order_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Invalid Order ID. It should be a number.")
         return TRACK_ORDER_ID
 
-    status_response = smm_api_call('status', {'order': order_id})
+    status_response = await asyncio.to_thread(smm_api_call, 'status', {'order': order_id})
     if status_response and 'status' in status_response:
         status = status_response['status']
         charge = status_response.get('charge', 'N/A')
         start_count = status_response.get('start_count', 'N/A')
         remains = status_response.get('remains', 'N/A')
+        await asyncio.to_thread(update_order_status, int(order_id), status)
 
         text = (f"**Order Status for ID:** `{order_id}`\n\n"
                 f"**Status:** `{status}`\n"
@@ -672,16 +1042,20 @@ async def order_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    orders = get_user_orders(user_id)
+    archived = query.data == "order_history_archive"
+    orders = get_user_orders(user_id, archived=archived)
 
     if not orders:
-        text = "You have no past orders."
+        text = "You have no older orders." if archived else "You have no past orders."
     else:
-        text = "📜 **Your Last 10 Orders:**\n\n"
+        text = "🗄 **Your Older Orders:**\n\n" if archived else "📜 **Your Last 10 Orders:**\n\n"
         for service_id, quantity, status, order_id in orders:
             text += f"ID: `{order_id}` | Svc: `{service_id}` | Qty: `{quantity}` | Stat: `{status}`\n"
     
-    keyboard = [[InlineKeyboardButton("⬅️ Back", callback_data="main_menu")]]
+    keyboard = []
+    if not archived:
+        keyboard.append([InlineKeyboardButton("🗄 Older Orders", callback_data="order_history_archive")])
+    keyboard.append([InlineKeyboardButton("⬅️ Back", callback_data="main_menu")])
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=constants.ParseMode.MARKDOWN)
 
 async def refer_earn(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -691,19 +1065,48 @@ async def refer_earn(update: Update, context: ContextTypes.DEFAULT_TYPE):
     bot_username = (await context.bot.get_me()).username
     referral_link = f"https://t.me/{bot_username}?start={user_id}"
 
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM users WHERE referred_by = ?", (user_id,))
-    referral_count = cursor.fetchone()[0]
-    conn.close()
+    referral_count = referral_graph.direct_count(user_id)
+    earnings = referral_graph.lifetime_earnings(user_id)
 
     text = (f"🎁 **Refer & Earn**\n\n"
-            f"Invite your friends and earn a `{REFERRAL_PERCENT}%` bonus on their first deposit!\n\n"
-            f"**Your unique referral link:**\n`{referral_link}`\n\n"
-            f"**Total users referred:** `{referral_count}`\n\n"
-            f"Share this link and start earning today!")
+            f"Invite your friends and earn a `{REFERRAL_TIERS[0]:g}%` bonus on their first deposit!\n")
+    if len(REFERRAL_TIERS) > 1:
+        text += "You also earn when the people they invite make their first deposit:\n"
+        for level, percent in enumerate(REFERRAL_TIERS[1:], 2):
+            text += f"- Level {level}: `{percent:g}%`\n"
+    text += (f"\n**Your unique referral link:**\n`{referral_link}`\n\n"
+             f"**Total users referred:** `{referral_count}`\n")
+    if len(REFERRAL_TIERS) > 1 and referral_count:
+        levels = referral_graph.downline_counts(user_id)
+        text += "**By level:** " + " | ".join(f"L{level}: `{count}`" for level, count in enumerate(levels, 1)) + "\n"
+    text += (f"**Lifetime earnings:** `{earnings:.2f}` coins\n\n"
+             f"Share this link and start earning today!")
     
-    keyboard = [[InlineKeyboardButton("⬅️ Back", callback_data="main_menu")]]
+    keyboard = [
+        [InlineKeyboardButton("🏆 Top Referrers", callback_data="referral_leaderboard")],
+        [InlineKeyboardButton("⬅️ Back", callback_data="main_menu")],
+    ]
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=constants.ParseMode.MARKDOWN)
+
+async def referral_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    top_referrers = referral_graph.top_referrers(10)
+    # Earnings are only shown to the admin
+    top_earners = referral_graph.top_earners(10) if query.from_user.id == ADMIN_ID else []
+    names = get_usernames({user_id for user_id, _ in top_referrers + top_earners})
+
+    text = "🏆 **Top Referrers**\n\n"
+    if not top_referrers:
+        text += "No referrals yet. Be the first!\n"
+    for rank, (user_id, count) in enumerate(top_referrers, 1):
+        text += f"{rank}. {escape_markdown(str(names.get(user_id) or user_id))} - `{count}` referrals\n"
+    if top_earners:
+        text += "\n💰 **Top Earners**\n\n"
+        for rank, (user_id, amount) in enumerate(top_earners, 1):
+            text += f"{rank}. {escape_markdown(str(names.get(user_id) or user_id))} (`{user_id}`) - `{amount:.2f}` coins\n"
+
+    keyboard = [[InlineKeyboardButton("⬅️ Back", callback_data="refer_earn")]]
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=constants.ParseMode.MARKDOWN)
 
 async def daily_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -716,17 +1119,54 @@ async def daily_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                       reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back", callback_data="main_menu")]]))
         return
         
-    is_ready, message = can_claim_bonus(user_id)
-    if is_ready:
-        update_balance(user_id, DAILY_BONUS_AMOUNT)
-        update_bonus_claim_time(user_id)
+    if await asyncio.to_thread(claim_daily_bonus, user_id):
         text = f"🎉 You've claimed your daily bonus of `{DAILY_BONUS_AMOUNT}` coins! Come back in 24 hours."
+        if BONUS_REMINDER_ENABLED:
+            schedule_bonus_reminder(context.job_queue, user_id, BONUS_COOLDOWN_SECONDS)
     else:
+        _, message = can_claim_bonus(user_id)
         text = f"⚠️ You have already claimed your bonus. Please wait. {message}"
 
     await query.edit_message_text(text, parse_mode=constants.ParseMode.MARKDOWN,
                                   reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back", callback_data="main_menu")]]))
 
+def schedule_bonus_reminder(job_queue, user_id, delay):
+    name = f"bonus_reminder_{user_id}"
+    for job in job_queue.get_jobs_by_name(name):
+        job.schedule_removal()
+    job_queue.run_once(bonus_reminder, when=delay, chat_id=user_id, user_id=user_id, name=name)
+
+def schedule_pending_bonus_reminders(job_queue, partition=None):
+    """Re-creates reminders for bonuses still cooling down, optionally for one (worker_index, workers) partition."""
+    now = int(time.time())
+    query = "SELECT user_id, last_bonus_epoch FROM users WHERE last_bonus_epoch > ?"
+    params = [now - BONUS_COOLDOWN_SECONDS]
+    if partition:
+        query += " AND user_id % ? = ?"
+        params += [partition[1], partition[0]]
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    pending = cursor.fetchall()
+    conn.close()
+    for user_id, last_claim in pending:
+        bonus_next_claim[user_id] = last_claim + BONUS_COOLDOWN_SECONDS
+        schedule_bonus_reminder(job_queue, user_id, last_claim + BONUS_COOLDOWN_SECONDS - now)
+
+async def bonus_reminder(context: ContextTypes.DEFAULT_TYPE):
+    user_id = context.job.user_id
+    is_ready, _ = can_claim_bonus(user_id)
+    if not is_ready:
+        return
+    try:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text="🎲 Your daily bonus is ready to claim!",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🎲 Daily Bonus", callback_data="daily_bonus")]])
+        )
+    except Exception as e:
+        logger.warning(f"Could not send bonus reminder to {user_id}: {e}")
+
 # --- Admin Panel ---
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -741,11 +1181,10 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     total_users = cursor.fetchone()[0]
     cursor.execute("SELECT SUM(balance) FROM users")
     total_balance = cursor.fetchone()[0] or 0
-    cursor.execute("SELECT COUNT(*) FROM orders")
-    total_orders = cursor.fetchone()[0]
     cursor.execute("SELECT COUNT(*) FROM deposits WHERE status = 'pending'")
     pending_deposits = cursor.fetchone()[0]
     conn.close()
+    total_orders = count_orders()
 
     text = (f"👑 **Admin Panel**\n\n"
             f"**Bot Statistics:**\n"
@@ -763,18 +1202,984 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=constants.ParseMode.MARKDOWN)
 
+# --- Admin Data Export ---
+# Table name -> (columns, date column used for the range filter)
+EXPORT_TABLES = {
+    "orders": (["order_id", "user_id", "service_id", "link", "quantity", "charge", "status", "timestamp"], "timestamp"),
+    "deposits": (["deposit_id", "user_id", "amount", "status", "timestamp", "message_id", "chat_id"], "timestamp"),
+    "users": (["user_id", "username", "balance", "referred_by", "join_date", "last_bonus_epoch"], "join_date"),
+}
+
+def write_export(table, date_from=None, date_to=None):
+    """Streams a table into gzipped CSV parts of up to EXPORT_PART_MAX_BYTES; returns (files, row_count)."""
+    columns, date_column = EXPORT_TABLES[table]
+    conditions, params = [], []
+    if date_from:
+        conditions.append(f"{date_column} >= ?")
+        params.append(date_from.strftime("%Y-%m-%d"))
+    if date_to:
+        conditions.append(f"{date_column} < ?")
+        params.append((date_to + timedelta(days=1)).strftime("%Y-%m-%d"))
+    where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+    query = f"SELECT {', '.join(columns)} FROM main.{table}{where}"
+
+    # Only touch the archive when the requested range reaches past the archival cutoff
+    archive_cutoff = datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    use_archive = table in ARCHIVE_TABLES and (date_from is None or date_from < archive_cutoff)
+    if use_archive:
+        # Archival copies rows before deleting them, so skip archived rows that are still in main
+        key = ARCHIVE_TABLES[table][0]
+        archive_where = (where + " AND" if where else " WHERE") + f" {key} NOT IN (SELECT {key} FROM main.{table})"
+        query += f" UNION ALL SELECT {', '.join(columns)} FROM archive.{table}{archive_where}"
+        params = params * 2
+    query += f" ORDER BY {date_column}"
+
+    parts, row_count = [], 0
+    spool = text = None
+    conn = sqlite3.connect(f"file:{DB_FILE}?mode=ro", uri=True)
+    try:
+        cursor = conn.cursor()
+        if use_archive:
+            cursor.execute("ATTACH DATABASE ? AS archive", (f"file:{ARCHIVE_DB_FILE}?mode=ro",))
+        cursor.execute(query, params)
+        while True:
+            if spool is None:
+                spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+                text = io.TextIOWrapper(gzip.GzipFile(fileobj=spool, mode="wb"), encoding="utf-8", newline="")
+                writer = csv.writer(text)
+                writer.writerow(columns)
+                part_rows = 0
+            rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            writer.writerows(rows)
+            row_count += len(rows)
+            part_rows += len(rows)
+            text.flush()
+            if spool.tell() >= EXPORT_PART_MAX_BYTES:
+                text.close() # Also closes the gzip stream, leaving the spool open
+                spool.seek(0)
+                parts.append(spool)
+                spool = None
+        text.close()
+        if part_rows or not parts:
+            spool.seek(0)
+            parts.append(spool)
+        else:
+            spool.close() # Header-only tail after the last full part
+    except Exception:
+        for part in parts + ([spool] if spool else []):
+            part.close()
+        raise
+    finally:
+        conn.close()
+    return parts, row_count
+
+async def run_export(context: ContextTypes.DEFAULT_TYPE, chat_id, table, date_from, date_to):
+    try:
+        parts, row_count = await asyncio.to_thread(write_export, table, date_from, date_to)
+    except Exception as e:
+        logger.error(f"Export of '{table}' failed: {e}")
+        await context.bot.send_message(chat_id=chat_id, text=f"❌ Export of '{table}' failed: {e}")
+        return
+
+    start_label = date_from.strftime("%Y%m%d") if date_from else "start"
+    end_label = date_to.strftime("%Y%m%d") if date_to else "now"
+    try:
+        for number, spool in enumerate(parts, start=1):
+            filename = f"{table}_{start_label}-{end_label}.csv.gz"
+            caption = f"📤 Export of `{table}`: `{row_count}` rows."
+            if len(parts) > 1:
+                filename = f"{table}_{start_label}-{end_label}_part{number}.csv.gz"
+                caption += f" Part {number}/{len(parts)}."
+            try:
+                await context.bot.send_document(
+                    chat_id=chat_id,
+                    document=spool,
+                    filename=filename,
+                    caption=caption,
+                    parse_mode=constants.ParseMode.MARKDOWN
+                )
+            except Exception as e:
+                logger.error(f"Sending export '{filename}' failed: {e}")
+                await context.bot.send_message(chat_id=chat_id, text=f"❌ Sending export file {filename} failed: {e}")
+                return
+            finally:
+                spool.close()
+    finally:
+        for spool in parts:
+            spool.close()
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command: /export <orders|deposits|users> [from YYYY-MM-DD] [to YYYY-MM-DD]"""
+    if update.effective_user.id != ADMIN_ID:
+        return
+
+    usage = "Usage: `/export <orders|deposits|users> [from YYYY-MM-DD] [to YYYY-MM-DD]`"
+    args = context.args or []
+    if not args or args[0] not in EXPORT_TABLES or len(args) > 3:
+        await update.message.reply_text(usage, parse_mode=constants.ParseMode.MARKDOWN)
+        return
+    try:
+        date_from = datetime.strptime(args[1], "%Y-%m-%d") if len(args) > 1 else None
+        date_to = datetime.strptime(args[2], "%Y-%m-%d") if len(args) > 2 else None
+    except ValueError:
+        await update.message.reply_text(usage, parse_mode=constants.ParseMode.MARKDOWN)
+        return
+
+    await update.message.reply_text(f"⏳ Exporting `{args[0]}`... the file will be sent when ready.",
+                                    parse_mode=constants.ParseMode.MARKDOWN)
+    # Run as a background task so the update queue keeps serving users during the export
+    context.application.create_task(run_export(context, update.effective_chat.id, args[0], date_from, date_to))
+
+# --- Archival Of Old Records ---
+# Table name -> (primary key, statuses that are final and safe to archive)
+ARCHIVE_TABLES = {
+    "orders": ("order_id", ("Completed", "Partial", "Canceled", "Refunded")),
+    "deposits": ("deposit_id", ("approved", "rejected")),
+}
+
+def open_archive_connection():
+    conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None)
+    conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_FILE,))
+    return conn
+
+def run_transaction(conn, sql, params):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(sql, params)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def archive_batch(conn, table):
+    """Moves up to ARCHIVE_BATCH_SIZE old finished rows of a table into the attached archive. Returns rows moved."""
+    key, statuses = ARCHIVE_TABLES[table]
+    cutoff = (datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    ids = [row[0] for row in conn.execute(
+        f"SELECT {key} FROM main.{table} WHERE status IN ({', '.join('?' * len(statuses))}) AND timestamp < ? LIMIT ?",
+        (*statuses, cutoff, ARCHIVE_BATCH_SIZE)
+    )]
+    if ids:
+        id_marks = ", ".join("?" * len(ids))
+        # WAL commits attached DBs separately, so copy first; a retry just replaces the copy
+        run_transaction(conn, f"INSERT OR REPLACE INTO archive.{table} SELECT * FROM main.{table} WHERE {key} IN ({id_marks})", ids)
+        # Only delete rows that made it into the archive
+        run_transaction(conn, f"DELETE FROM main.{table} WHERE {key} IN ({id_marks}) "
+                              f"AND {key} IN (SELECT {key} FROM archive.{table} WHERE {key} IN ({id_marks}))", ids * 2)
+    return len(ids)
+
+def archive_old_records():
+    """Moves finished orders and deposits older than ARCHIVE_AFTER_DAYS into the archive DB, in batches."""
+    moved = {}
+    conn = open_archive_connection()
+    try:
+        for table in ARCHIVE_TABLES:
+            moved[table] = 0
+            while True:
+                count = archive_batch(conn, table)
+                moved[table] += count
+                if count < ARCHIVE_BATCH_SIZE:
+                    break
+                time.sleep(ARCHIVE_BATCH_PAUSE)
+    finally:
+        conn.close()
+    return moved
+
+async def archive_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        moved = await asyncio.to_thread(archive_old_records)
+    except Exception as e:
+        logger.error(f"Archival job failed: {e}")
+        return
+    if any(moved.values()):
+        logger.info(f"Archived old records: {moved}")
+
+# --- Order Status Sync ---
+def refresh_order_statuses():
+    """Updates every unfinished order from the panel, ORDER_STATUS_BATCH_SIZE ids per call. Returns the number changed."""
+    final_statuses = ARCHIVE_TABLES["orders"][1]
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT order_id, status FROM orders WHERE status NOT IN ({', '.join('?' * len(final_statuses))})",
+                   final_statuses)
+    open_orders = dict(cursor.fetchall())
+    conn.close()
+
+    order_ids = list(open_orders)
+    changed = 0
+    for start in range(0, len(order_ids), ORDER_STATUS_BATCH_SIZE):
+        batch = order_ids[start:start + ORDER_STATUS_BATCH_SIZE]
+        response = smm_api_call('status', {'orders': ",".join(map(str, batch))})
+        if not isinstance(response, dict):
+            continue
+        statements = []
+        for order_id in batch:
+            result = response.get(str(order_id))
+            if isinstance(result, dict) and result.get('status') and result['status'] != open_orders[order_id]:
+                statements.append(("UPDATE orders SET status = ? WHERE order_id = ?", (result['status'], order_id)))
+        if statements:
+            db_write(*statements)
+            changed += len(statements)
+    return changed
+
+async def order_status_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        changed = await asyncio.to_thread(refresh_order_statuses)
+    except Exception as e:
+        logger.error(f"Order status sync failed: {e}")
+        return
+    if changed:
+        logger.info(f"Updated the status of {changed} orders")
+
+# --- Online Backups ---
+class BackupRestartLimit(Exception):
+    """Raised from the backup progress callback when concurrent writes keep restarting the copy."""
+
+def snapshot_prefix(db_file):
+    return os.path.splitext(os.path.basename(db_file))[0] + "-"
+
+def list_backups(db_file):
+    """Returns snapshot file names for a database, newest first."""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    prefix = snapshot_prefix(db_file)
+    names = [n for n in os.listdir(BACKUP_DIR) if n.startswith(prefix) and n.endswith(".db.gz")]
+    return sorted(names, reverse=True)
+
+def probe_writer_stall(db_file, stop, stats):
+    """Times taking the write lock from its own connection until `stop` is set, keeping the worst wait."""
+    conn = sqlite3.connect(db_file, timeout=30, isolation_level=None)
+    try:
+        while not stop.wait(BACKUP_PROBE_INTERVAL):
+            started = time.monotonic()
+            conn.execute("BEGIN IMMEDIATE")
+            stats["max_stall"] = max(stats["max_stall"], time.monotonic() - started)
+            conn.execute("ROLLBACK") # Nothing was written, so the backup is not restarted
+    except sqlite3.Error as e:
+        logger.warning(f"Writer stall probe for {db_file} failed: {e}")
+    finally:
+        conn.close()
+
+def backup_database(db_file):
+    """Snapshots a live database with the online backup API, a few pages per step. Returns backup stats."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    # Microseconds keep names unique when snapshots are taken back to back
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f")
+    name = f"{snapshot_prefix(db_file)}{stamp}.db.gz"
+    stats = {"name": name, "max_stall": 0.0, "restarts": 0, "fallback": False}
+    last_remaining = [None]
+
+    def progress(status, remaining, total):
+        # Remaining pages not going down means another connection wrote and the copy restarted
+        if last_remaining[0] is not None and remaining >= last_remaining[0]:
+            stats["restarts"] += 1
+        last_remaining[0] = remaining
+        if stats["restarts"] >= BACKUP_MAX_RESTARTS:
+            raise BackupRestartLimit()
+        time.sleep(BACKUP_STEP_PAUSE)
+
+    started = time.monotonic()
+    fd, raw_path = tempfile.mkstemp(suffix=".db", dir=BACKUP_DIR)
+    os.close(fd)
+    gz_path = os.path.join(BACKUP_DIR, name + ".part")
+    stop_probe = threading.Event()
+    probe = threading.Thread(target=probe_writer_stall, args=(db_file, stop_probe, stats), daemon=True)
+    probe.start()
+    try:
+        src = sqlite3.connect(db_file)
+        dst = sqlite3.connect(raw_path)
+        try:
+            try:
+                src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=progress)
+            except BackupRestartLimit:
+                # Writes keep restarting the stepped copy, so copy the rest in one step
+                stats["fallback"] = True
+                src.backup(dst)
+        finally:
+            stop_probe.set()
+            probe.join()
+            dst.close()
+            src.close()
+        with open(raw_path, "rb") as raw, gzip.open(gz_path, "wb") as gz:
+            shutil.copyfileobj(raw, gz)
+        os.replace(gz_path, os.path.join(BACKUP_DIR, name))
+    finally:
+        for path in (raw_path, gz_path):
+            if os.path.exists(path):
+                os.remove(path)
+    stats["duration"] = time.monotonic() - started
+    stats["size"] = os.path.getsize(os.path.join(BACKUP_DIR, name))
+
+    for old_name in list_backups(db_file)[BACKUP_KEEP:]:
+        os.remove(os.path.join(BACKUP_DIR, old_name))
+    return stats
+
+def backup_all_databases():
+    return [backup_database(db_file) for db_file in (DB_FILE, ARCHIVE_DB_FILE)]
+
+def restore_database(name):
+    """Restores a snapshot over its live database after an integrity check, backing up the current one first."""
+    db_file = next((f for f in (DB_FILE, ARCHIVE_DB_FILE) if name in list_backups(f)), None)
+    if db_file is None:
+        raise ValueError(f"Unknown snapshot: {name}")
+
+    fd, raw_path = tempfile.mkstemp(suffix=".db", dir=BACKUP_DIR)
+    os.close(fd)
+    try:
+        with gzip.open(os.path.join(BACKUP_DIR, name), "rb") as gz, open(raw_path, "wb") as raw:
+            shutil.copyfileobj(gz, raw)
+        src = sqlite3.connect(raw_path)
+        try:
+            result = src.execute("PRAGMA integrity_check").fetchone()[0]
+            if result != "ok":
+                raise ValueError(f"Snapshot {name} failed integrity check: {result}")
+            backup_database(db_file)
+            dst = sqlite3.connect(db_file, timeout=30)
+            try:
+                src.backup(dst)
+            finally:
+                dst.close()
+        finally:
+            src.close()
+    finally:
+        os.remove(raw_path)
+    return db_file
+
+def format_backup_stats(stats):
+    text = (f"`{stats['name']}` ({stats['size'] / 1024:.1f} KB) in `{stats['duration']:.2f}s`, "
+            f"max writer stall `{stats['max_stall'] * 1000:.1f}ms`, restarts `{stats['restarts']}`")
+    if stats["fallback"]:
+        text += ", finished as a one-step copy"
+    return text
+
+async def backup_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        results = await asyncio.to_thread(backup_all_databases)
+    except Exception as e:
+        logger.error(f"Backup job failed: {e}")
+        return
+    for stats in results:
+        logger.info(f"Backup {stats['name']} took {stats['duration']:.2f}s, "
+                    f"max writer stall {stats['max_stall'] * 1000:.1f}ms, restarts {stats['restarts']}"
+                    f"{', one-step fallback' if stats['fallback'] else ''}")
+
+async def run_backup(context: ContextTypes.DEFAULT_TYPE, chat_id):
+    try:
+        results = await asyncio.to_thread(backup_all_databases)
+    except Exception as e:
+        logger.error(f"Manual backup failed: {e}")
+        await context.bot.send_message(chat_id=chat_id, text=f"❌ Backup failed: {e}")
+        return
+    text = "💾 **Backup Complete**\n\n" + "\n".join(f"- {format_backup_stats(stats)}" for stats in results)
+    await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=constants.ParseMode.MARKDOWN)
+
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command: /backup"""
+    if update.effective_user.id != ADMIN_ID:
+        return
+    await update.message.reply_text("⏳ Backup started...")
+    context.application.create_task(run_backup(context, update.effective_chat.id))
+
+async def restore_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command: /restore [snapshot name]"""
+    if update.effective_user.id != ADMIN_ID:
+        return
+
+    if not context.args:
+        names = list_backups(DB_FILE)[:5] + list_backups(ARCHIVE_DB_FILE)[:5]
+        if not names:
+            await update.message.reply_text("No backups found.")
+            return
+        text = "💾 **Latest Backups**\n\n" + "\n".join(f"`{n}`" for n in names)
+        text += "\n\nRestore with `/restore <name>`."
+        await update.message.reply_text(text, parse_mode=constants.ParseMode.MARKDOWN)
+        return
+
+    try:
+        db_file = await asyncio.to_thread(run_db_task, "restore_database", context.args[0])
+    except Exception as e:
+        logger.error(f"Restore of {context.args[0]} failed: {e}")
+        await update.message.reply_text(f"❌ Restore failed: {e}")
+        return
+    if db_file == DB_FILE:
+        # Cached state may no longer match the restored rows
+        bonus_next_claim.clear()
+        referral_graph.load()
+    await update.message.reply_text(f"✅ Restored `{db_file}` from `{context.args[0]}`.",
+                                    parse_mode=constants.ParseMode.MARKDOWN)
+
 # Fallback for conversation handlers
 async def conv_fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Action cancelled or timed out.")
     await main_menu(update, context)
     return ConversationHandler.END
 
+# --- Update Scheduling ---
+# Priority classes, highest first
+PRIORITY_ADMIN, PRIORITY_MONEY, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND = range(4)
+PRIORITY_NAMES = {
+    PRIORITY_ADMIN: "admin",
+    PRIORITY_MONEY: "money",
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_BACKGROUND: "background",
+}
+# Max updates of each class processed at the same time
+PRIORITY_LIMITS = {
+    PRIORITY_ADMIN: int(os.getenv("SCHED_LIMIT_ADMIN", "4")),
+    PRIORITY_MONEY: int(os.getenv("SCHED_LIMIT_MONEY", "4")),
+    PRIORITY_INTERACTIVE: int(os.getenv("SCHED_LIMIT_INTERACTIVE", "6")),
+    PRIORITY_BACKGROUND: int(os.getenv("SCHED_LIMIT_BACKGROUND", "3")),
+}
+MONEY_CALLBACKS = ("confirm_order_final", "approve_deposit_", "reject_deposit_")
+BACKGROUND_CALLBACKS = ("main_menu", "check_join", "new_order_category", "cat_")
+
+def update_user_id(update):
+    if isinstance(update, Update) and update.effective_user:
+        return update.effective_user.id
+    return None
+
+def classify_update(update):
+    user_id = update_user_id(update)
+    if user_id is None:
+        return PRIORITY_BACKGROUND
+    if user_id == ADMIN_ID:
+        return PRIORITY_ADMIN
+    if update.callback_query:
+        data = update.callback_query.data or ""
+        if data.startswith(MONEY_CALLBACKS):
+            return PRIORITY_MONEY
+        if data.startswith(BACKGROUND_CALLBACKS):
+            return PRIORITY_BACKGROUND
+        return PRIORITY_INTERACTIVE
+    if update.message:
+        if update.message.photo: # Deposit screenshots
+            return PRIORITY_MONEY
+        if (update.message.text or "").startswith("/start"):
+            return PRIORITY_BACKGROUND
+    return PRIORITY_INTERACTIVE
+
+class PriorityUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates concurrently by priority class, one at a time per user, shedding background ones under load."""
+
+    def __init__(self, max_concurrent_updates, shed_threshold):
+        # The base semaphore only caps how many updates are admitted; slots are handed out here
+        super().__init__(SCHED_MAX_PENDING)
+        self.max_running = max_concurrent_updates
+        self.shed_threshold = shed_threshold
+        self.waiting = {cls: collections.deque() for cls in PRIORITY_NAMES}
+        self.running = {cls: 0 for cls in PRIORITY_NAMES}
+        self.total_running = 0
+        self.user_locks = {}
+        self.stats = {cls: {"processed": 0, "shed": 0, "wait_total": 0.0, "wait_max": 0.0} for cls in PRIORITY_NAMES}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def queue_depth(self):
+        return sum(len(waiters) for waiters in self.waiting.values())
+
+    def dispatch(self):
+        """Hands free slots to the oldest waiter of the highest class that still has capacity."""
+        while self.total_running < self.max_running:
+            for cls, waiters in self.waiting.items():
+                while waiters and waiters[0].cancelled():
+                    waiters.popleft()
+                if waiters and self.running[cls] < PRIORITY_LIMITS[cls]:
+                    self.running[cls] += 1
+                    self.total_running += 1
+                    waiters.popleft().set_result(None)
+                    break
+            else:
+                return
+
+    async def acquire_slot(self, cls):
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiting[cls].append(waiter)
+        self.dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release_slot(cls)
+            raise
+
+    def release_slot(self, cls):
+        self.running[cls] -= 1
+        self.total_running -= 1
+        self.dispatch()
+
+    async def shed(self, update, coroutine):
+        coroutine.close()
+        if not isinstance(update, Update):
+            return
+        busy_text = "⏳ The bot is busy, please try again in a moment."
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(busy_text)
+            elif update.message:
+                await update.message.reply_text(busy_text)
+        except Exception as e:
+            logger.warning(f"Could not notify user of shed update: {e}")
+
+    async def do_process_update(self, update, coroutine):
+        cls = classify_update(update)
+        stats = self.stats[cls]
+        if cls == PRIORITY_BACKGROUND and self.queue_depth() >= self.shed_threshold:
+            stats["shed"] += 1
+            await self.shed(update, coroutine)
+            return
+
+        user_id = update_user_id(update)
+        lock, refs = self.user_locks.get(user_id, (asyncio.Lock(), 0))
+        self.user_locks[user_id] = (lock, refs + 1)
+        queued_at = time.monotonic()
+        try:
+            async with lock:
+                await self.acquire_slot(cls)
+                waited = time.monotonic() - queued_at
+                stats["wait_total"] += waited
+                stats["wait_max"] = max(stats["wait_max"], waited)
+                try:
+                    await coroutine
+                finally:
+                    stats["processed"] += 1
+                    self.release_slot(cls)
+        finally:
+            lock, refs = self.user_locks[user_id]
+            if refs == 1:
+                del self.user_locks[user_id]
+            else:
+                self.user_locks[user_id] = (lock, refs - 1)
+
+    def snapshot(self):
+        """Returns per-class queue depth, running count and wait-time metrics."""
+        result = {}
+        for cls, name in PRIORITY_NAMES.items():
+            stats = self.stats[cls]
+            result[name] = {
+                "queued": len(self.waiting[cls]),
+                "running": self.running[cls],
+                "processed": stats["processed"],
+                "shed": stats["shed"],
+                "wait_avg": stats["wait_total"] / stats["processed"] if stats["processed"] else 0.0,
+                "wait_max": stats["wait_max"],
+            }
+        return result
+
+async def scheduler_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command: /scheduler"""
+    if update.effective_user.id != ADMIN_ID:
+        return
+    processor = context.application.update_processor
+    if not isinstance(processor, PriorityUpdateProcessor):
+        await update.message.reply_text("The priority scheduler is not active.")
+        return
+
+    text = f"🚦 **Update Scheduler** (`{processor.total_running}/{processor.max_running}` running)\n\n"
+    for name, metrics in processor.snapshot().items():
+        text += (f"**{name}:** queued `{metrics['queued']}`, running `{metrics['running']}`, "
+                 f"done `{metrics['processed']}`, shed `{metrics['shed']}`, "
+                 f"wait avg `{metrics['wait_avg'] * 1000:.0f}ms` max `{metrics['wait_max'] * 1000:.0f}ms`\n")
+    await update.message.reply_text(text, parse_mode=constants.ParseMode.MARKDOWN)
+
+# --- On-Demand Profiler ---
+def collapse_stack(frame):
+    """Returns a frame's call stack, outermost first, as 'func (file:line)' entries."""
+    entries = []
+    while frame is not None:
+        code = frame.f_code
+        entries.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    entries.reverse()
+    return entries
+
+class SamplingProfiler:
+    """Samples all thread stacks into collapsed-stack counts and records event loop stalls."""
+
+    def __init__(self, loop, interval=PROFILE_INTERVAL, slow_threshold=PROFILE_SLOW_CALLBACK_MS / 1000):
+        self.loop = loop
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.slow_callbacks = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.loop_thread_id = None
+        self.last_tick = time.monotonic()
+        self.started = None
+
+    def start(self):
+        """Starts sampling. Must be called from the event loop thread."""
+        self.loop_thread_id = threading.get_ident()
+        self.started = time.monotonic()
+        self.heartbeat()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def heartbeat(self):
+        self.last_tick = time.monotonic()
+        if not self.stopped.is_set():
+            self.loop.call_later(self.interval, self.heartbeat)
+
+    def run(self):
+        stall = None
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            frames = sys._current_frames()
+            for thread_id, frame in frames.items():
+                if thread_id == own_id:
+                    continue
+                stack = [names.get(thread_id, str(thread_id))] + collapse_stack(frame)
+                self.counts[";".join(stack)] += 1
+            self.samples += 1
+
+            lag = time.monotonic() - self.last_tick - self.interval
+            loop_frame = frames.get(self.loop_thread_id)
+            if lag > self.slow_threshold and loop_frame is not None:
+                if stall is None:
+                    stall = {"started": self.last_tick, "stack": "".join(traceback.format_stack(loop_frame))}
+                stall["duration"] = lag
+            elif stall is not None:
+                self.slow_callbacks.append(stall)
+                stall = None
+        if stall is not None:
+            self.slow_callbacks.append(stall)
+
+    def collapsed_stacks(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.counts.most_common()) + "\n"
+
+    def slow_callback_report(self):
+        lines = []
+        for stall in sorted(self.slow_callbacks, key=lambda s: s["duration"], reverse=True):
+            offset = stall["started"] - self.started
+            lines.append(f"=== Event loop blocked for {stall['duration'] * 1000:.0f}ms at +{offset:.2f}s ===")
+            lines.append(stall["stack"])
+        return "\n".join(lines)
+
+# Only one profiling session runs at a time
+active_profiler = None
+
+async def run_profile(context: ContextTypes.DEFAULT_TYPE, profiler, seconds):
+    global active_profiler
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        await asyncio.to_thread(profiler.stop)
+        active_profiler = None
+
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    worst = max((s["duration"] for s in profiler.slow_callbacks), default=0)
+    text = (f"🔬 **Profile Complete**\n\n"
+            f"- Duration: `{seconds}s`\n"
+            f"- Samples: `{profiler.samples}`\n"
+            f"- Slow callbacks (>{PROFILE_SLOW_CALLBACK_MS}ms): `{len(profiler.slow_callbacks)}`\n"
+            f"- Worst event loop stall: `{worst * 1000:.0f}ms`")
+    await context.bot.send_message(chat_id=ADMIN_ID, text=text, parse_mode=constants.ParseMode.MARKDOWN)
+    await context.bot.send_document(
+        chat_id=ADMIN_ID,
+        document=profiler.collapsed_stacks().encode(),
+        filename=f"profile-{stamp}.folded",
+        caption="Collapsed stacks - open with speedscope.app or flamegraph.pl"
+    )
+    if profiler.slow_callbacks:
+        await context.bot.send_document(
+            chat_id=ADMIN_ID,
+            document=profiler.slow_callback_report().encode(),
+            filename=f"slow-callbacks-{stamp}.txt"
+        )
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command: /profile [seconds]"""
+    global active_profiler
+    if update.effective_user.id != ADMIN_ID:
+        return
+    if active_profiler is not None:
+        await update.message.reply_text("A profiling session is already running.")
+        return
+
+    seconds = 30
+    if context.args:
+        if not context.args[0].isdigit() or not 1 <= int(context.args[0]) <= PROFILE_MAX_SECONDS:
+            await update.message.reply_text(f"Usage: /profile [seconds], between 1 and {PROFILE_MAX_SECONDS}.")
+            return
+        seconds = int(context.args[0])
+
+    active_profiler = SamplingProfiler(asyncio.get_running_loop())
+    active_profiler.start()
+    await update.message.reply_text(f"🔬 Profiling for {seconds}s... results will be sent here.")
+    context.application.create_task(run_profile(context, active_profiler, seconds))
+
+
+# --- Multi-Process Mode ---
+class DatabaseWriterClient:
+    """Sends writes from a worker process to the DB writer process; a reader thread hands back each response."""
+
+    def __init__(self, worker_index, request_queue, response_queue):
+        self.worker_index = worker_index
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+        # Start from the clock so a restarted worker never reuses ids its predecessor left in flight
+        self.request_ids = itertools.count(time.time_ns())
+        self.pending = {}
+        self.lock = threading.Lock()
+        threading.Thread(target=self.read_responses, name="db-writer-client", daemon=True).start()
+
+    def read_responses(self):
+        while True:
+            request_id, ok, result = self.response_queue.get()
+            with self.lock:
+                slot = self.pending.pop(request_id, None)
+            if slot is None: # The caller already gave up waiting
+                continue
+            slot[1] = (ok, result)
+            slot[0].set()
+
+    def request(self, kind, payload, timeout):
+        """Sends a request and waits for its result; raises TimeoutError, though a timed-out write may still commit."""
+        slot = [threading.Event(), None]
+        with self.lock:
+            request_id = next(self.request_ids)
+            self.pending[request_id] = slot
+        self.request_queue.put((self.worker_index, request_id, kind, payload))
+        if not slot[0].wait(timeout):
+            with self.lock:
+                self.pending.pop(request_id, None)
+            if slot[1] is None:
+                raise TimeoutError(f"DB writer did not answer {kind} request within {timeout}s")
+        ok, result = slot[1]
+        if not ok:
+            raise result
+        return result
+
+    def execute(self, statements):
+        return self.request("write", list(statements), WRITER_TIMEOUT)
+
+    def call(self, name, *args):
+        return self.request("call", (name, args), WRITER_CALL_TIMEOUT)
+
+# Whole-database tasks that must run in the writer process when there is one
+DB_TASKS = {
+    "restore_database": restore_database,
+}
+
+def run_db_task(name, *args):
+    if db_writer is not None:
+        return db_writer.call(name, *args)
+    return DB_TASKS[name](*args)
+
+def picklable_error(error):
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")
+
+def commit_group(conn, requests):
+    """Commits a batch of write requests in one transaction, each in its own savepoint. Returns (worker_index, response)."""
+    cursor = conn.cursor()
+    responses = []
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        for worker_index, request_id, _, statements in requests:
+            cursor.execute("SAVEPOINT request")
+            try:
+                response = (request_id, True, execute_statements(cursor, statements))
+            except sqlite3.Error as e:
+                cursor.execute("ROLLBACK TO request")
+                response = (request_id, False, picklable_error(e))
+            cursor.execute("RELEASE request")
+            responses.append((worker_index, response))
+        cursor.execute("COMMIT")
+    except sqlite3.Error as e:
+        logger.error(f"Group commit of {len(requests)} requests failed: {e}")
+        if conn.in_transaction:
+            cursor.execute("ROLLBACK")
+        error = picklable_error(e)
+        return [(worker_index, (request_id, False, error)) for worker_index, request_id, _, _ in requests]
+    return responses
+
+def run_db_writer(request_queue, response_queues, archive_interval=ARCHIVE_INTERVAL_HOURS * 3600):
+    """Entry point of the DB writer process, which group-commits all writes and runs archival between groups."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # The dispatcher shuts us down
+    conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None)
+    archive_conn = None
+    next_archive = time.monotonic() + 60 if archive_interval else None
+    archive_tables = [] # Tables left in the archival run in progress
+    archive_moved = {}
+    running = True
+    while running:
+        if archive_tables:
+            timeout = 0 # Don't wait for writes while archival has batches left
+        else:
+            timeout = max(0, next_archive - time.monotonic()) if next_archive else None
+        try:
+            batch = [request_queue.get(timeout=timeout)]
+        except queue.Empty:
+            batch = []
+        while batch and len(batch) < WRITER_BATCH_SIZE:
+            try:
+                batch.append(request_queue.get_nowait())
+            except queue.Empty:
+                break
+        if None in batch:
+            running = False
+            batch = [request for request in batch if request is not None]
+
+        writes = [request for request in batch if request[2] == "write"]
+        if writes:
+            for worker_index, response in commit_group(conn, writes):
+                response_queues[worker_index].put(response)
+        for worker_index, request_id, _, (name, args) in (r for r in batch if r[2] == "call"):
+            try:
+                response = (request_id, True, DB_TASKS[name](*args))
+            except Exception as e:
+                logger.error(f"Writer task {name} failed: {e}")
+                response = (request_id, False, picklable_error(e))
+            response_queues[worker_index].put(response)
+
+        if not archive_tables and next_archive and time.monotonic() >= next_archive:
+            archive_tables = list(ARCHIVE_TABLES)
+            archive_moved = dict.fromkeys(ARCHIVE_TABLES, 0)
+        if archive_tables:
+            # One short batch per loop, so pending writes are committed in between
+            try:
+                if archive_conn is None:
+                    archive_conn = open_archive_connection()
+                count = archive_batch(archive_conn, archive_tables[0])
+                archive_moved[archive_tables[0]] += count
+                if count < ARCHIVE_BATCH_SIZE:
+                    archive_tables.pop(0)
+            except Exception as e:
+                logger.error(f"Archival failed: {e}")
+                archive_tables = []
+            if not archive_tables:
+                if any(archive_moved.values()):
+                    logger.info(f"Archived old records: {archive_moved}")
+                next_archive = time.monotonic() + archive_interval
+    if archive_conn is not None:
+        archive_conn.close()
+    conn.close()
+
+def partition_for(update, workers):
+    return (update_user_id(update) or 0) % workers
+
+async def route_update(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Dispatcher handler: passes each update to the worker that owns its user."""
+    worker_queues = context.bot_data["worker_queues"]
+    worker_queues[partition_for(update, len(worker_queues))].put(update.to_dict())
+
+async def referral_refresh_job(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(referral_graph.refresh)
+
+async def feed_worker(application, update_queue):
+    async with application:
+        await application.start()
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await loop.run_in_executor(None, update_queue.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await application.stop()
+
+def run_worker(worker_index, workers, update_queue, request_queue, response_queue):
+    """Entry point of a worker process, which handles the updates of its share of users."""
+    global db_writer
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # The dispatcher shuts us down
+    db_writer = DatabaseWriterClient(worker_index, request_queue, response_queue)
+    referral_graph.load()
+
+    application = build_application(updater=False)
+    application.job_queue.run_repeating(referral_refresh_job, interval=REFERRAL_GRAPH_REFRESH_SECONDS,
+                                        first=REFERRAL_GRAPH_REFRESH_SECONDS)
+    if worker_index == 0: # One worker is enough to keep order statuses in sync
+        application.job_queue.run_repeating(order_status_job, interval=ORDER_STATUS_INTERVAL_MINUTES * 60, first=120)
+    if BONUS_ENABLED and BONUS_REMINDER_ENABLED:
+        schedule_pending_bonus_reminders(application.job_queue, partition=(worker_index, workers))
+    asyncio.run(feed_worker(application, update_queue))
+
+async def monitor_processes(context: ContextTypes.DEFAULT_TYPE):
+    """Restarts dead workers, and shuts the bot down with an error if the DB writer died."""
+    writer = context.bot_data["writer"]
+    if not writer.is_alive():
+        logger.critical(f"DB writer exited with code {writer.exitcode}, shutting down")
+        context.bot_data["writer_failed"] = True
+        context.application.stop_running()
+        return
+    processes = context.bot_data["workers"]
+    for i, process in enumerate(processes):
+        if not process.is_alive():
+            logger.error(f"Worker {i} exited with code {process.exitcode}, restarting it")
+            processes[i] = context.bot_data["start_worker"](i)
+
+def run_multiprocess(workers):
+    """Runs a polling dispatcher that routes updates by user ID to `workers` worker processes, plus one DB writer."""
+    mp_context = multiprocessing.get_context("spawn")
+    request_queue = mp_context.Queue()
+    response_queues = [mp_context.Queue() for _ in range(workers)]
+    update_queues = [mp_context.Queue() for _ in range(workers)]
+    writer = mp_context.Process(target=run_db_writer, args=(request_queue, response_queues), name="db-writer")
+    writer.start()
+
+    def start_worker(i):
+        process = mp_context.Process(target=run_worker, name=f"worker-{i}",
+                                     args=(i, workers, update_queues[i], request_queue, response_queues[i]))
+        process.start()
+        return process
+
+    processes = [start_worker(i) for i in range(workers)]
 
-def main() -> None:
-    """Run the bot."""
-    setup_database()
-    
     application = Application.builder().token(BOT_TOKEN).build()
+    application.bot_data["worker_queues"] = update_queues
+    application.bot_data["writer"] = writer
+    application.bot_data["workers"] = processes
+    application.bot_data["start_worker"] = start_worker
+    application.add_handler(TypeHandler(Update, route_update))
+    # Backups only read, so they can run in the dispatcher
+    application.job_queue.run_repeating(backup_job, interval=BACKUP_INTERVAL_HOURS * 3600, first=300)
+    application.job_queue.run_repeating(monitor_processes, interval=PROCESS_CHECK_SECONDS, first=PROCESS_CHECK_SECONDS)
+
+    logger.info(f"Bot is starting with {workers} workers...")
+    try:
+        application.run_polling()
+    finally:
+        for update_queue in update_queues:
+            update_queue.put(None)
+        for process in processes:
+            process.join(timeout=30)
+        request_queue.put(None)
+        writer.join(timeout=30)
+        for process in processes + [writer]:
+            if process.is_alive():
+                logger.warning(f"{process.name} did not exit in time, terminating it")
+                process.terminate()
+    if application.bot_data.get("writer_failed"):
+        sys.exit(1) # Let the process manager restart the whole bot
+
+
+def build_application(updater=True, request=None):
+    """Builds the Application with all handlers registered; `request` swaps the Bot API transport (see benchmark.py)."""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PriorityUpdateProcessor(SCHED_MAX_CONCURRENT, SCHED_SHED_THRESHOLD))
+    )
+    if not updater:
+        # Worker processes get their updates from the dispatcher instead of polling
+        builder = builder.updater(None)
+    if request is not None:
+        builder = builder.request(request)
+    application = builder.build()
     
     # --- Conversation Handlers ---
     add_funds_handler = ConversationHandler(
@@ -820,8 +2225,9 @@ def main() -> None:
     
     # Main menu buttons
     application.add_handler(CallbackQueryHandler(account_info, pattern='^account$'))
-    application.add_handler(CallbackQueryHandler(order_history, pattern='^order_history$'))
+    application.add_handler(CallbackQueryHandler(order_history, pattern='^order_history(_archive)?$'))
     application.add_handler(CallbackQueryHandler(refer_earn, pattern='^refer_earn$'))
+    application.add_handler(CallbackQueryHandler(referral_leaderboard, pattern='^referral_leaderboard$'))
     application.add_handler(CallbackQueryHandler(daily_bonus, pattern='^daily_bonus$'))
     
     # Conversation handlers
@@ -833,11 +2239,36 @@ def main() -> None:
     application.add_handler(CallbackQueryHandler(admin_panel, pattern='^admin_panel$'))
     application.add_handler(CallbackQueryHandler(approve_deposit, pattern=r'^approve_deposit_'))
     application.add_handler(CallbackQueryHandler(reject_deposit, pattern=r'^reject_deposit_'))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("backup", backup_command))
+    application.add_handler(CommandHandler("restore", restore_command))
+    application.add_handler(CommandHandler("scheduler", scheduler_command))
+    application.add_handler(CommandHandler("profile", profile_command))
+
+    return application
+
+
+def main() -> None:
+    """Run the bot."""
+    setup_database()
+    setup_archive_database()
+    if WORKERS > 1:
+        run_multiprocess(WORKERS)
+        return
+    referral_graph.load()
+    
+    application = build_application()
+
+    # Scheduled jobs
+    application.job_queue.run_repeating(archive_job, interval=ARCHIVE_INTERVAL_HOURS * 3600, first=60)
+    application.job_queue.run_repeating(backup_job, interval=BACKUP_INTERVAL_HOURS * 3600, first=300)
+    application.job_queue.run_repeating(order_status_job, interval=ORDER_STATUS_INTERVAL_MINUTES * 60, first=120)
+    if BONUS_ENABLED and BONUS_REMINDER_ENABLED:
+        schedule_pending_bonus_reminders(application.job_queue)
     
     # Run the bot
     logger.info("Bot is starting...")
     application.run_polling()
 
-
 if __name__ == "__main__":
     main()